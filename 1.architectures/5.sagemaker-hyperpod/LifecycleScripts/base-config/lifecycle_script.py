@@ -1,19 +1,50 @@
 #!/usr/bin/env python
 
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from enum import Enum
+import fcntl
 import json
 import os
 import socket
+import struct
 import subprocess
 import sys
+import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from config import Config
 
+# The optional modules below are installed by the install_packages Ansible role, which
+# on_create.sh runs before this script. The fallbacks keep the script working without them.
+try:
+    # orjson parses in C and is much faster on large resource configs.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # ijson lets us stream the resource config instead of materializing it at once.
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # inotify lets us wake up as soon as slurm.conf is written instead of polling it.
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import netifaces
+except ImportError:
+    netifaces = None
+
 
 SLURM_CONF = os.getenv("SLURM_CONF", "/opt/slurm/etc/slurm.conf")
+# Serializes the output blocks of scripts run concurrently by execute_scripts
+_output_lock = threading.Lock()
 
 class SlurmNodeType(str, Enum):
     HEAD_NODE = "controller"
@@ -21,16 +52,75 @@ class SlurmNodeType(str, Enum):
     COMPUTE_NODE = "compute"
 
 
+def load_json(path: str) -> Any:
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r") as f:
+        return json.load(f)
+
+
 class ExecuteBashScript:
     def __init__(self, script_name: str):
         self.script_name = script_name
+        self.path = os.path.abspath(script_name)
+
+    def _command(self) -> List[str]:
+        command = ["bash", self.path]
+        # Lifecycle scripts normally run as root, skip the extra sudo process when we already are
+        if os.geteuid() != 0:
+            command = ["sudo", "-n", *command]
+        return command
 
     def run(self, *args):
         print(f"Execute script: {self.script_name} {' '.join([str(x) for x in args])}")
-        result = subprocess.run(["sudo", "bash", self.script_name, *args])
+        result = subprocess.run([*self._command(), *args])
         result.check_returncode()
         print(f"Script {self.script_name} executed successully")
 
+    def run_captured(self, *args):
+        """
+        Runs the script with its output captured, then prints the output as one block tagged
+        with the script name, so that concurrent scripts don't interleave in the provisioning log.
+        """
+        result = subprocess.run(
+            [*self._command(), *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+        )
+        lines = [f"Execute script: {self.script_name} {' '.join([str(x) for x in args])}"]
+        lines += [f"[{self.script_name}] {line}" for line in result.stdout.splitlines()]
+        if result.returncode == 0:
+            lines.append(f"Script {self.script_name} executed successully")
+        else:
+            lines.append(f"Script {self.script_name} failed with exit code {result.returncode}")
+        with _output_lock:
+            print("\n".join(lines), flush=True)
+        result.check_returncode()
+
+
+def execute_scripts(scripts: Dict[str, Tuple[Tuple[Any, ...], Set[str]]]):
+    """
+    Runs independent scripts concurrently, each one starting as soon as its dependencies completed.
+    Args:
+        scripts: Maps a script name to its arguments and the names of scripts that must complete first.
+            Dependencies which are not part of the mapping are ignored.
+    """
+    pending = dict(scripts)
+    completed = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(scripts))) as executor:
+        while pending or running:
+            for name, (args, deps) in list(pending.items()):
+                if deps & scripts.keys() <= completed:
+                    del pending[name]
+                    running[executor.submit(ExecuteBashScript(name).run_captured, *args)] = name
+            if not running:
+                raise ValueError(f"Circular dependencies between scripts: {', '.join(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+                completed.add(name)
+
 
 class ResourceConfig:
     INSTANCE_GROUP_NAME = "Name"
@@ -38,22 +128,40 @@ class ResourceConfig:
     CUSTOMER_IP_ADDRESS = "CustomerIpAddress"
 
     def __init__(self, path: str):
-        with open(path, "r") as f:
-            self._config = json.load(f)
+        # Index groups by name and instances by address once, so lookups don't rescan the config
+        self._groups_by_name: Dict[str, Dict[str, Any]] = {}
+        self._instances_by_address: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+        if ijson is not None:
+            # Stream one instance group at a time, the file is closed before any script runs
+            with open(path, "rb") as f:
+                for group in ijson.items(f, "InstanceGroups.item"):
+                    self._add_group(group)
+        else:
+            for group in load_json(path)["InstanceGroups"]:
+                self._add_group(group)
+
+    def _add_group(self, group: Dict[str, Any]):
+        # Only keep the fields we look up, so memory doesn't grow with the full config
+        instances = [
+            {
+                ResourceConfig.INSTANCE_NAME: i.get(ResourceConfig.INSTANCE_NAME),
+                ResourceConfig.CUSTOMER_IP_ADDRESS: i.get(ResourceConfig.CUSTOMER_IP_ADDRESS),
+            }
+            for i in group.get("Instances") or []
+        ]
+        group = {ResourceConfig.INSTANCE_GROUP_NAME: group.get(ResourceConfig.INSTANCE_GROUP_NAME), "Instances": instances}
+        self._groups_by_name.setdefault(group[ResourceConfig.INSTANCE_GROUP_NAME], group)
+        for instance in instances:
+            self._instances_by_address.setdefault(instance[ResourceConfig.CUSTOMER_IP_ADDRESS], (group, instance))
 
     def find_instance_by_address(self, address) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
-        for group in self._config["InstanceGroups"]:
-            for instance in group.get("Instances") or []:
-                if instance.get(ResourceConfig.CUSTOMER_IP_ADDRESS) == address:
-                    return group, instance
-        return None, None
+        return self._instances_by_address.get(address, (None, None))
 
     def get_list_of_addresses(self, group_name) -> List[str]:
-        for group in self._config["InstanceGroups"]:
-            if group.get(ResourceConfig.INSTANCE_GROUP_NAME) != group_name:
-                continue
-            return [i.get(ResourceConfig.CUSTOMER_IP_ADDRESS) for i in group.get("Instances") or []]
-        return []
+        group = self._groups_by_name.get(group_name)
+        if group is None:
+            return []
+        return [i.get(ResourceConfig.CUSTOMER_IP_ADDRESS) for i in group.get("Instances") or []]
 
 
 class ProvisioningParameters:
@@ -64,8 +172,7 @@ class ProvisioningParameters:
     SLURM_CONFIGURATIONS: str = "slurm_configurations"
 
     def __init__(self, path: str):
-        with open(path, "r") as f:
-            self._params = json.load(f)
+        self._params = load_json(path)
 
     @property
     def workload_manager(self) -> Optional[str]:
@@ -95,13 +202,53 @@ class ProvisioningParameters:
 
         return slurm_configurations
 
+SIOCGIFADDR = 0x8915
+
+def get_default_interface_address() -> Optional[str]:
+    """
+    Reads the IPv4 address of the default route interface from the kernel, without any network round trip.
+    Returns:
+        str: The IP address, or None if it could not be determined.
+    """
+    if netifaces is not None:
+        try:
+            interface = netifaces.gateways()["default"][netifaces.AF_INET][1]
+            return netifaces.ifaddresses(interface)[netifaces.AF_INET][0]["addr"]
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"Failed to get IP address with netifaces. Reason: {repr(e)}.")
+
+    try:
+        interface = None
+        with open("/proc/net/route", "rt") as f:
+            next(f)  # header
+            for line in f:
+                fields = line.split()
+                # The default route has an all-zero destination and the gateway flag set
+                if fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                    interface = fields[0]
+                    break
+        if interface is None:
+            return None
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack("256s", interface[:15].encode()))
+        return socket.inet_ntoa(ifreq[20:24])
+    except (OSError, StopIteration, IndexError, ValueError) as e:
+        print(f"Failed to get IP address from the default route. Reason: {repr(e)}.")
+    return None
+
 def get_ip_address():
-    max_retries = 7
-    retry_delay_seconds = 5
+    IP = get_default_interface_address()
+    if IP is not None:
+        return IP
+
+    # Fall back to asking the kernel which source address it would route through
+    max_retries = 2
+    retry_delay_seconds = 1
     IP = '127.0.0.1'
 
     retry_count = 0
     while retry_count < max_retries:
+        s = None
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             # doesn't even have to be reachable
@@ -114,11 +261,11 @@ def get_ip_address():
             if retry_count < max_retries:
                 print(f"Retrying in {retry_delay_seconds} seconds...")
                 time.sleep(retry_delay_seconds)
-                retry_delay_seconds = retry_delay_seconds * 2  # Exponential backoff
             else:    
                 print(f"Exceeded maximum retries ({max_retries}) to get IP address. Returning default IP address {IP}.")
         finally:
-            s.close()
+            if s is not None:
+                s.close()
     return IP
 
 
@@ -131,19 +278,38 @@ def wait_for_slurm_conf(controllers: List[str]) -> bool:
     """
     sleep = 5 # sec
     timeout = 60  # sec
-    for i in range(timeout // sleep):
-        if not os.path.exists(SLURM_CONF):
-            print("slurm.conf is not present. It is fine for login/compute nodes")
-            return True
-        with open(SLURM_CONF, "rt") as f:
-            data = f.read()
-            # check if controller information is present
-            for ip in controllers:
-                if ip in data:
-                    print("slurm.conf found. It contains at least one controller address")
-                    return True
-        time.sleep(sleep)
-    return False
+    deadline = time.monotonic() + timeout
+    inotify = None
+    if INotify is not None and os.path.isdir(os.path.dirname(SLURM_CONF)):
+        # Watch before the first read so that a write in between is not missed
+        inotify = INotify()
+        inotify.add_watch(
+            os.path.dirname(SLURM_CONF),
+            inotify_flags.CREATE | inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO,
+        )
+    try:
+        while True:
+            if not os.path.exists(SLURM_CONF):
+                print("slurm.conf is not present. It is fine for login/compute nodes")
+                return True
+            with open(SLURM_CONF, "rt") as f:
+                data = f.read()
+                # check if controller information is present
+                for ip in controllers:
+                    if ip in data:
+                        print("slurm.conf found. It contains at least one controller address")
+                        return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if inotify is not None:
+                # Block until something in the slurm config directory changes
+                inotify.read(timeout=int(remaining * 1000))
+            else:
+                time.sleep(min(sleep, remaining))
+    finally:
+        if inotify is not None:
+            inotify.close()
 
 def wait_for_scontrol():
     """
@@ -153,8 +319,10 @@ def wait_for_scontrol():
         bool: True if the command returns output from scontrol within the specified time, False otherwise.
     """
     timeout = 120
-    sleep = 5
-    for i in range (timeout // sleep):
+    sleep = 1
+    max_sleep = 16
+    deadline = time.monotonic() + timeout
+    while True:
         try:
             output = subprocess.check_output(['scontrol', 'show', 'nodes'])
             if output.strip():
@@ -163,14 +331,24 @@ def wait_for_scontrol():
         except subprocess.CalledProcessError:
             pass
 
-        print(f"Waiting for output. Retrying in {sleep} seconds...")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Start with short waits since nodes usually register quickly, then back off
+        sleep = min(sleep, remaining)
+        print(f"Waiting for output. Retrying in {sleep:.0f} seconds...")
         time.sleep(sleep)
+        sleep = min(sleep * 2, max_sleep)
 
     print(f"Exceeded maximum wait time of {timeout} seconds. No output from scontrol.")
     return False
 
 
 def main(args):
+    if os.geteuid() != 0:
+        # Cache sudo credentials once, scripts are then run with non-interactive sudo
+        subprocess.run(["sudo", "-v"], check=True)
+
     params = ProvisioningParameters(args.provisioning_parameters)
     resource_config = ResourceConfig(args.resource_config)
 
@@ -197,7 +375,7 @@ def main(args):
         print("This is a slurm cluster. Do additional slurm setup")
         # self_ip = get_ip_address()
         self_ip = os.environ.get("ANSIBLE_NODE_IP", get_ip_address())
-        head_node_ip = resource_config.get_list_of_addresses(params.controller_group)
+        head_node_ip = controllers
         login_node_ip = resource_config.get_list_of_addresses(params.login_group)
         print(f"This node ip address is {self_ip}")
 
@@ -242,17 +420,24 @@ def main(args):
 
         # Install metric exporting software and Prometheus for observability
         if Config.enable_observability:
+            # Exporters running in docker containers don't touch shared system state,
+            # install them concurrently with the scripts which do
             if node_type == SlurmNodeType.COMPUTE_NODE:
                 # ExecuteBashScript("./utils/install_docker.sh").run()
-                ExecuteBashScript("./utils/install_dcgm_exporter.sh").run()
-                ExecuteBashScript("./utils/install_efa_node_exporter.sh").run()
+                execute_scripts({
+                    "./utils/install_dcgm_exporter.sh": ((), set()),
+                    "./utils/install_efa_node_exporter.sh": ((), set()),
+                })
 
             if node_type == SlurmNodeType.HEAD_NODE:
                 # wait_for_scontrol()
                 # ExecuteBashScript("./utils/install_docker.sh").run()
-                ExecuteBashScript("./utils/install_slurm_exporter.sh").run()
-                ExecuteBashScript("./utils/install_head_node_exporter.sh").run()
-                ExecuteBashScript("./utils/install_prometheus.sh").run()
+                execute_scripts({
+                    "./utils/install_slurm_exporter.sh": ((), set()),
+                    "./utils/install_head_node_exporter.sh": ((), set()),
+                    # Both install and reload systemd units
+                    "./utils/install_prometheus.sh": ((), {"./utils/install_slurm_exporter.sh"}),
+                })
         
         # Install Docker/Enroot/Pyxis
         if Config.enable_docker_enroot_pyxis:
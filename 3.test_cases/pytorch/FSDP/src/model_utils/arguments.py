@@ -38,6 +38,13 @@ def parse_args():  # pylint: disable=too-many-statements
                          default=0.2,
                          type=float,
                          help="weight decay")
+    opt_grp.add_argument(
+        "--optimizer",
+        type=str,
+        default="adamw",
+        choices=["adamw", "adamw8bit"],
+        help="adamw8bit keeps optimizer states in 8 bits, requires bitsandbytes and does not support checkpointing",
+    )
     opt_grp.add_argument("--beta1",
                          default=0.9,
                          type=float,
@@ -91,6 +98,19 @@ def parse_args():  # pylint: disable=too-many-statements
     fsdp_grp.add_argument("--offload_activations", type=int, default=0)
     fsdp_grp.add_argument("--activation_loading_horizon", type=int, default=2)
     fsdp_grp.add_argument("--limit_all_gathers", default=1, type=int)
+    fsdp_grp.add_argument(
+        "--backward_prefetch",
+        type=str,
+        default="backward_pre",
+        choices=["backward_pre", "backward_post"],
+        help="FSDP backward prefetch policy https://pytorch.org/docs/stable/fsdp.html#torch.distributed.fsdp.BackwardPrefetch",
+    )
+    fsdp_grp.add_argument(
+        "--forward_prefetch",
+        type=int,
+        default=1,
+        help="prefetch the next all-gather during the forward pass",
+    )
     fsdp_grp.add_argument(
         "--sharding_strategy",
         type=str,
@@ -98,6 +118,12 @@ def parse_args():  # pylint: disable=too-many-statements
         choices=["full", "hybrid"],
         help="FSDP sharding strategy https://pytorch.org/docs/stable/fsdp.html",
     )
+    fsdp_grp.add_argument(
+        "--compile",
+        type=int,
+        default=0,
+        help="compile the FSDP model with torch.compile https://pytorch.org/docs/stable/generated/torch.compile.html",
+    )
     fsdp_grp.add_argument(
         "--cpu_offload",
         type=int,
@@ -155,6 +181,12 @@ def parse_args():  # pylint: disable=too-many-statements
     io_grp.add_argument("--tokenizer",
                         type=str,
                         default="EleutherAI/gpt-neox-20b")
+    io_grp.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Shared dir to cache tokenized sequences in, instead of tokenizing the streaming dataset on every run",
+    )
     io_grp.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -178,6 +210,12 @@ def parse_args():  # pylint: disable=too-many-statements
         default=1000,
         help="number of iterations between checkpointing",
     )
+    parser.add_argument(
+        "--async_checkpoint",
+        type=int,
+        default=0,
+        help="write checkpoints in the background while training continues",
+    )
     parser.add_argument(
         "--validation_freq",
         type=int,
@@ -22,7 +22,22 @@ from model_utils.train_utils import get_logger
 
 logger = get_logger()
 
-def save_checkpoint(model, optimizer, scheduler, user_content, root_dir, sub_dir):
+_checkpoint_future = None
+
+def wait_for_checkpoint():
+    """Wait until the pending asynchronous checkpoint, if any, is written."""
+    global _checkpoint_future
+    if _checkpoint_future is None:
+        return
+    _checkpoint_future.result()
+    _checkpoint_future = None
+    if dist.get_rank() == 0:
+        logger.info("Completed checkpoint.")
+
+def save_checkpoint(model, optimizer, scheduler, user_content, root_dir, sub_dir, async_save=False):
+    global _checkpoint_future
+    # Keep at most one checkpoint staged in host memory
+    wait_for_checkpoint()
     torch.cuda.empty_cache()
 
     save_dir = os.path.join(root_dir, sub_dir)
@@ -39,10 +54,19 @@ def save_checkpoint(model, optimizer, scheduler, user_content, root_dir, sub_dir
             "total_steps": user_content["total_steps"],
             "start_batch_index": user_content["start_batch_index"],
         }
-        dist_cp.save_state_dict(
-                    state_dict=state_dict,
-                    storage_writer=dist_cp.FileSystemWriter(save_dir)
-                )
+        if async_save:
+            # The state dict is copied to CPU before returning, writing it happens in the background
+            _checkpoint_future = dist_cp.async_save(
+                        state_dict=state_dict,
+                        storage_writer=dist_cp.FileSystemWriter(save_dir)
+                    )
+        else:
+            dist_cp.save_state_dict(
+                        state_dict=state_dict,
+                        storage_writer=dist_cp.FileSystemWriter(save_dir)
+                    )
+    if async_save:
+        return
     dist.barrier()
     if dist.get_rank() == 0:
         logger.info("Completed checkpoint.")
@@ -4,7 +4,7 @@
 import os
 import numpy as np
 import datasets as hf_datasets
-from torch.utils.data import IterableDataset
+from torch.utils.data import Dataset, IterableDataset
 from typing import Dict, Iterable, Union
 from transformers import PreTrainedTokenizerBase
 
@@ -40,3 +40,27 @@ class ConcatTokensDataset(IterableDataset):
                 concat_sample_mask = mask_buffer[:self.max_length]
                 mask_buffer = mask_buffer[self.max_length:] if self.should_wrap else []
                 yield np.array(concat_sample)
+
+
+def cached_chunk_path(cache_path: str, chunk_idx: int) -> str:
+    return os.path.join(cache_path, f"chunk-{chunk_idx:05d}.npy")
+
+
+class CachedTokensDataset(Dataset):
+    """Token sequences cached in .npy chunks by `create_cached_dataloader`, memory-mapped on first access."""
+
+    def __init__(self, cache_path: str, num_samples: int, chunk_size: int):
+        self.cache_path = cache_path
+        self.num_samples = num_samples
+        self.chunk_size = chunk_size
+        # Opened lazily so that dataloader workers map the files themselves
+        self.chunks = {}
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        chunk_idx, row = divmod(idx, self.chunk_size)
+        if chunk_idx not in self.chunks:
+            self.chunks[chunk_idx] = np.load(cached_chunk_path(self.cache_path, chunk_idx), mmap_mode='r')
+        return self.chunks[chunk_idx][row].astype(np.int64)
@@ -3,11 +3,16 @@
 
 import os
 import math
+import time
+import json
+import uuid
+import hashlib
+import itertools
 import functools
 import numpy as np
 import torch
 import torch.distributed as dist
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 from datetime import datetime
 import tqdm
 import logging
@@ -15,7 +20,7 @@ from torch.distributed.fsdp import BackwardPrefetch, ShardingStrategy
 from transformers import AutoTokenizer
 from datasets import load_dataset
 
-from model_utils.concat_dataset import ConcatTokensDataset
+from model_utils.concat_dataset import CachedTokensDataset, ConcatTokensDataset, cached_chunk_path
 
 from transformers import LlamaForCausalLM, LlamaTokenizer, LlamaConfig
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer
@@ -317,6 +322,36 @@ def apply_activation_checkpoint(args, model=None):
         model, checkpoint_wrapper_fn=entrant_wrapper, check_fn=check_fn_gpt
     )
 
+def get_param_init_fn(model, init_weights=False):
+    """Get FSDP param_init_fn materializing meta parameters on GPU."""
+    def param_init_fn(module):
+        # FSDP calls this on every module, leave the ones holding only real buffers untouched
+        if not any(p.is_meta for p in module.parameters(recurse=False)):
+            return
+        module.to_empty(device=torch.device("cuda"), recurse=False)
+        if init_weights:
+            # Same initialization as `from_config`, other ranks receive it through sync_module_states
+            model._init_weights(module)
+
+    return param_init_fn
+
+def clip_grad_norm_(model, max_norm, norm_type=2.0):
+    """Clip gradients of the FSDP model, with multi-tensor kernels over the local shards."""
+    parameters = [p for p in model.parameters() if p.grad is not None]
+    norm_type = float(norm_type)
+    local_norm = torch.nn.utils.get_total_norm([p.grad for p in parameters], norm_type)
+    # Ranks of a sharding group hold disjoint gradient shards, combine their norms
+    local_norm = local_norm.to(torch.cuda.current_device(), torch.float32)
+    if norm_type == math.inf:
+        total_norm = local_norm
+        dist.all_reduce(total_norm, op=dist.ReduceOp.MAX, group=model.process_group)
+    else:
+        total_norm = local_norm ** norm_type
+        dist.all_reduce(total_norm, group=model.process_group)
+        total_norm = total_norm ** (1.0 / norm_type)
+    torch.nn.utils.clip_grads_with_norm_(parameters, max_norm, total_norm)
+    return total_norm
+
 def get_param_groups_by_weight_decay(module):
     """Get param groups."""
     weight_decay_params = {"params": []}
@@ -503,6 +538,7 @@ def create_streaming_dataloader(dataset,
                       batch_size=1,
                       max_context_width=4096,
                       workers=4,
+                      prefetch_factor=4,
                       split=None):
     print(f"dataset={dataset}, name={name}")
     tokenizer = AutoTokenizer.from_pretrained(tokenizer,legacy=False)
@@ -512,6 +548,141 @@ def create_streaming_dataloader(dataset,
                                        batch_size=batch_size,
                                        num_workers=workers,
                                        pin_memory=True,
-                                       prefetch_factor=4,
+                                       prefetch_factor=prefetch_factor,
+                                       persistent_workers=True,
                                        timeout=600)
     return train_dataloader
+
+def _read_token_cache_index(cache_path, chunk_size=None):
+    index_path = os.path.join(cache_path, "index.json")
+    if not os.path.exists(index_path):
+        return {"chunk_size": chunk_size, "chunks": 0, "sequences": 0, "documents": 0, "exhausted": False}
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+def _write_token_cache_index(cache_path, index):
+    index_path = os.path.join(cache_path, "index.json")
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def _extend_token_cache(cache_path, index, dataset, tokenizer, name, split, max_context_width, num_samples):
+    """Tokenize chunks of sequences until the cache holds at least `num_samples` of them."""
+    chunk_size = index["chunk_size"]
+    if index["sequences"] >= num_samples or index["exhausted"]:
+        return index
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer,legacy=False)
+    # Continue the stream after the documents already cached
+    data = load_dataset(dataset, name=name, streaming=True, split=split).shuffle(42).skip(index["documents"])
+    documents = index["documents"]
+
+    def count_documents():
+        nonlocal documents
+        for sample in data:
+            documents += 1
+            yield sample
+
+    sequences = iter(ConcatTokensDataset(count_documents(), tokenizer, max_context_width, True))
+    while index["sequences"] < num_samples and not index["exhausted"]:
+        chunk_path = cached_chunk_path(cache_path, index["chunks"])
+        tmp_path = f"{chunk_path}.{os.getpid()}.tmp"
+        tokens = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int32, shape=(chunk_size, max_context_width)
+        )
+        n_sequences = 0
+        for sample in itertools.islice(sequences, chunk_size):
+            tokens[n_sequences] = sample
+            n_sequences += 1
+        if n_sequences < chunk_size:
+            # The split is exhausted, keep the sequences it had as a shorter last chunk
+            tokens = np.array(tokens[:n_sequences])
+            with open(tmp_path, "wb") as f:
+                np.save(f, tokens)
+            index["exhausted"] = True
+        else:
+            tokens.flush()
+        del tokens
+        if n_sequences > 0:
+            os.replace(tmp_path, chunk_path)
+            index["chunks"] += 1
+        else:
+            os.remove(tmp_path)
+        index["sequences"] += n_sequences
+        index["documents"] = documents
+        # Publish after each chunk so that interrupted runs keep what they tokenized
+        _write_token_cache_index(cache_path, index)
+    return index
+
+def create_cached_dataloader(dataset,
+                      tokenizer,
+                      cache_dir,
+                      num_samples,
+                      name=None,
+                      global_rank=0,
+                      world_size=1,
+                      batch_size=1,
+                      max_context_width=4096,
+                      workers=4,
+                      prefetch_factor=4,
+                      chunk_size=4096,
+                      wait_timeout=24 * 3600,
+                      split=None):
+    """Create a dataloader over tokenized sequences cached in `cache_dir`.
+
+    Rank 0 tokenizes the streaming dataset into memory-mapped .npy chunks,
+    extending the cache only by the chunks missing for `num_samples`
+    sequences, so later runs reuse it whatever their length or world size.
+    `cache_dir` must be shared by all nodes (e.g. on FSx).
+    """
+    key = hashlib.sha256(
+        f"{dataset}|{name}|{split}|{tokenizer}|{max_context_width}".encode()
+    ).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, key)
+    print(f"dataset={dataset}, name={name}, cache={cache_path}")
+    # Unique per run, so that a failure left over by a previous run isn't picked up
+    run_id = [uuid.uuid4().hex if global_rank == 0 else None]
+    dist.broadcast_object_list(run_id, src=0)
+    failed_path = os.path.join(cache_path, f"failed-{run_id[0]}")
+
+    if global_rank == 0:
+        os.makedirs(cache_path, exist_ok=True)
+        try:
+            # An existing cache keeps the chunk size it was created with
+            index = _read_token_cache_index(cache_path, chunk_size)
+            index = _extend_token_cache(cache_path, index, dataset, tokenizer, name, split,
+                                        max_context_width, num_samples)
+            if index["sequences"] < num_samples:
+                raise ValueError(
+                    f"Split {split} of {dataset} only has {index['sequences']} of {num_samples} sequences"
+                )
+        except Exception as e:
+            # Let the other ranks fail too instead of waiting for the cache
+            with open(failed_path, "w") as f:
+                f.write(repr(e))
+            raise
+    else:
+        # Poll instead of dist.barrier(), tokenizing can take longer than the collective timeout
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            if os.path.exists(failed_path):
+                with open(failed_path, "r") as f:
+                    raise RuntimeError(f"Rank 0 failed to build the token cache {cache_path}: {f.read()}")
+            if os.path.isdir(cache_path):
+                index = _read_token_cache_index(cache_path)
+                if index["sequences"] >= num_samples:
+                    break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Token cache {cache_path} not ready after {wait_timeout} seconds")
+            time.sleep(10)
+
+    cached_dataset = CachedTokensDataset(cache_path, num_samples, index["chunk_size"])
+    sampler = DistributedSampler(cached_dataset, num_replicas=world_size, rank=global_rank, shuffle=False)
+    return DataLoader(cached_dataset,
+                      batch_size=batch_size,
+                      sampler=sampler,
+                      num_workers=workers,
+                      pin_memory=True,
+                      prefetch_factor=prefetch_factor,
+                      persistent_workers=True,
+                      timeout=600)
@@ -3,9 +3,9 @@
 
 import datetime
 import functools
+import itertools
 import math
 import re
-import time
 
 import numpy as np
 import torch
@@ -15,6 +15,7 @@ import torch.utils.data
 
 import transformers
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from accelerate import init_empty_weights
 from datasets import load_dataset
 
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
@@ -32,10 +33,13 @@ from model_utils.train_utils import (get_model_config,
                                    get_backward_fetch_policy,
                                    apply_activation_checkpoint,
                                    get_param_groups_by_weight_decay,
+                                   clip_grad_norm_,
+                                   get_param_init_fn,
                                    get_logger,
                                    get_learning_rate_scheduler,
-                                   create_streaming_dataloader)
-from model_utils.checkpoint import save_checkpoint, load_checkpoint
+                                   create_streaming_dataloader,
+                                   create_cached_dataloader)
+from model_utils.checkpoint import save_checkpoint, load_checkpoint, wait_for_checkpoint
 from model_utils.arguments import parse_args
 
 logger = get_logger()
@@ -44,21 +48,20 @@ def eval_model(model, dataloader, num_batches):
     """Eval step."""
     model = model.eval()
     n_batches = 0
-    loss = 0.0
+    # Keep per-batch losses on device, they are reduced and read back once at the end
+    losses = torch.zeros(num_batches, device=torch.cuda.current_device())
 
     with torch.no_grad():
-        for batch_idx, input_data in enumerate(dataloader):
-            if batch_idx >= num_batches:
-                break
-
-            loss += model(input_ids=input_data, attention_mask=None, labels=input_data)["loss"]
+        # Stop pulling from the dataloader once we have enough batches
+        for input_data in itertools.islice(dataloader, num_batches):
+            input_data = input_data.to(torch.cuda.current_device(), non_blocking=True)
+            losses[n_batches] = model(input_ids=input_data, attention_mask=None, labels=input_data)["loss"]
             n_batches += 1
 
     if n_batches > 0:
-        detached_loss = loss.detach()
-        torch.distributed.all_reduce(detached_loss)
-        loss = detached_loss.item() / dist.get_world_size()
-        loss /= n_batches
+        losses = losses[:n_batches]
+        dist.all_reduce(losses, op=dist.ReduceOp.SUM)
+        loss = losses.sum().item() / (dist.get_world_size() * n_batches)
         ppl = math.exp(loss)
     else:
         loss = -1.0
@@ -81,25 +84,33 @@ def train(
         start_batch_index=0
     ):
     model.train()
+    step_start = torch.cuda.Event(enable_timing=True)
+    step_end = torch.cuda.Event(enable_timing=True)
+    # Batches have a static shape, so the number of samples per step is constant
+    sample_processed = args.train_batch_size * world_size
     for index in range(args.epochs):
-        for batch_idx, input_data in enumerate(train_dataloader):
-            if batch_idx < start_batch_index:
-                continue
+        # When resuming, skip the batches already consumed in the first epoch only
+        batches = itertools.islice(train_dataloader, start_batch_index, None)
+        for batch_idx, input_data in enumerate(batches, start=start_batch_index):
+            # Batches come from pinned memory, so the copy can overlap with queued kernels
+            input_data = input_data.to(torch.cuda.current_device(), non_blocking=True)
             optimizer.zero_grad(set_to_none=True)
-            step_start = time.time()
+            step_start.record()
             loss = model(input_ids=input_data, attention_mask=None, labels=input_data)["loss"]
             loss.backward()
-            model.clip_grad_norm_(args.grad_clip)
+            clip_grad_norm_(model, args.grad_clip)
             optimizer.step()
             lr_scheduler.step()
+            step_end.record()
             total_steps += 1
-            loss_metric = loss.item()
-            step_time = time.time() - step_start
-            sample_processed = input_data.shape[0] * world_size
-            throughput = sample_processed / step_time
-            loss_scalar = loss.item()
-            current_lr = lr_scheduler.get_lr()
             if global_rank==0 and batch_idx%args.logging_freq==0:
+                # Only sync with the device on logging steps, so that the
+                # host can keep queuing kernels for the following steps.
+                step_end.synchronize()
+                step_time = step_start.elapsed_time(step_end) / 1000
+                throughput = sample_processed / step_time
+                loss_scalar = loss.item()
+                current_lr = lr_scheduler.get_lr()
                 logger.info(
                     "Batch %d Loss: %.5f, Speed: %.2f samples/sec, lr: %.6f",  # pylint: disable=line-too-long
                     batch_idx,
@@ -135,16 +146,27 @@ def train(
                     user_content,
                     args.checkpoint_dir,
                     sub_dir,
+                    async_save=args.async_checkpoint > 0,
                 )
             if total_steps >= args.max_steps:
                 break
+        start_batch_index = 0
             
 
 def main(args):
+    if args.optimizer == "adamw8bit" and (args.checkpoint_dir or args.resume_from_checkpoint):
+        # FSDP.optim_state_dict unflattens every optimizer state like the flat parameter,
+        # which the quantization maps and block-wise scales of the 8-bit states are not
+        raise NotImplementedError(
+            "Checkpointing is not supported with --optimizer=adamw8bit, "
+            "unset --checkpoint_dir and --resume_from_checkpoint or use --optimizer=adamw"
+        )
+
     dist.init_process_group()
     global_rank = dist.get_rank()
     device = global_rank % torch.cuda.device_count()
     world_size = dist.get_world_size()
+    torch.cuda.set_device(device)
     
     if args.bf16:
         dtype = torch.bfloat16
@@ -156,18 +178,18 @@ def main(args):
         logger.info(
             "Creating Model"
         )
-    # Instantiate model on CPU on rank=0 only to prevent CPU OOM
-    # (e.g. 70B * 4 bytes * 8 processes > 2T RAM available on P5)
-    if global_rank == 0:
+    # Instantiate model parameters on `meta` device on all ranks to prevent CPU OOM
+    # (e.g. 70B * 4 bytes * 8 processes > 2T RAM available on P5).
+    # Buffers (e.g. rotary embeddings) are small and stay on CPU.
+    # Parameters are materialized on GPU by `param_init_fn=...`, initialized on rank=0
+    # only and broadcast with `sync_module_states=True` in FSDP c-tor.
+    with init_empty_weights():
         model = AutoModelForCausalLM.from_config(model_config)
-    else:
-        with torch.device("meta"):
-            # Instantiating model on `meta` device doesn't consume CPU memory,
-            # but requires specifing `param_init_fn=...`
-            # and `sync_module_states=True` in FSDP c-tor.
-            model = AutoModelForCausalLM.from_config(model_config)
     
-    num_params = compute_num_params(model)
+    # Only rank 0 walks the parameters, the other ranks receive the count
+    num_params = [int(compute_num_params(model)) if global_rank == 0 else None]
+    dist.broadcast_object_list(num_params, src=0)
+    num_params = num_params[0]
     if global_rank == 0:
         logger.info(
             "Created model with total parameters: %d (%.2f B)", num_params, num_params * 1e-9
@@ -181,7 +203,6 @@ def main(args):
         },
     )
 
-    torch.cuda.set_device(device)
     mixed_precision_policy = MixedPrecision(
         param_dtype=dtype, reduce_dtype=dtype, buffer_dtype=dtype
     )
@@ -203,13 +224,15 @@ def main(args):
         auto_wrap_policy=gpt_auto_wrap_policy,
         mixed_precision=mixed_precision_policy,
         limit_all_gathers=args.limit_all_gathers,
+        backward_prefetch=get_backward_fetch_policy(args.backward_prefetch),
+        forward_prefetch=args.forward_prefetch > 0,
         device_id=torch.cuda.current_device(),
-        use_orig_params=False,
+        # torch.compile only supports FSDP with the original parameters exposed
+        use_orig_params=args.compile > 0,
         sharding_strategy=sharding_strategy,
         cpu_offload=cpu_offload,
         sync_module_states=True,
-        param_init_fn=(lambda module: module.to_empty(device=torch.device("cuda"), recurse=False))
-        if global_rank != 0 else None,
+        param_init_fn=get_param_init_fn(model, init_weights=global_rank == 0),
     )
 
     if global_rank == 0:
@@ -218,6 +241,11 @@ def main(args):
     if args.activation_checkpointing > 0:
         apply_activation_checkpoint(args, model=model)
 
+    if args.compile > 0:
+        # Compile in place to keep the state dict keys of the checkpoints unchanged.
+        # Input shapes are static, and CUDA graphs can't capture the FSDP collectives.
+        model.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
+
     if args.offload_activations > 0:
         from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import offload_wrapper
 
@@ -225,9 +253,16 @@ def main(args):
 
     param_groups = get_param_groups_by_weight_decay(model)
 
-    optimizer = optim.AdamW(
-        param_groups, betas=(args.beta1, args.beta2), lr=args.lr, weight_decay=args.weight_decay
-    )
+    if args.optimizer == "adamw8bit":
+        import bitsandbytes as bnb
+
+        optimizer = bnb.optim.PagedAdamW8bit(
+            param_groups, betas=(args.beta1, args.beta2), lr=args.lr, weight_decay=args.weight_decay
+        )
+    else:
+        optimizer = optim.AdamW(
+            param_groups, betas=(args.beta1, args.beta2), lr=args.lr, weight_decay=args.weight_decay
+        )
 
     if global_rank == 0:
         logger.info("Created optimizer")
@@ -251,17 +286,40 @@ def main(args):
         total_steps = 0
         start_batch_index = 0
     
-    train_dataloader = create_streaming_dataloader(args.dataset, 
-                                                   args.tokenizer, 
-                                                   name=args.dataset_config_name, 
-                                                   batch_size=args.train_batch_size, 
-                                                   split='train')
-    
-    val_dataloader = create_streaming_dataloader(args.dataset, 
-                                                  args.tokenizer, 
-                                                  name=args.dataset_config_name, 
-                                                  batch_size=args.train_batch_size, 
+    if args.dataset_cache_dir:
+        train_dataloader = create_cached_dataloader(args.dataset,
+                                                    args.tokenizer,
+                                                    args.dataset_cache_dir,
+                                                    args.max_steps * args.train_batch_size * world_size,
+                                                    name=args.dataset_config_name,
+                                                    global_rank=global_rank,
+                                                    world_size=world_size,
+                                                    batch_size=args.train_batch_size,
+                                                    split='train')
+
+        val_dataloader = create_cached_dataloader(args.dataset,
+                                                  args.tokenizer,
+                                                  args.dataset_cache_dir,
+                                                  args.validation_batches * args.train_batch_size * world_size,
+                                                  name=args.dataset_config_name,
+                                                  global_rank=global_rank,
+                                                  world_size=world_size,
+                                                  batch_size=args.train_batch_size,
+                                                  prefetch_factor=2,
                                                   split='validation')
+    else:
+        train_dataloader = create_streaming_dataloader(args.dataset, 
+                                                       args.tokenizer, 
+                                                       name=args.dataset_config_name, 
+                                                       batch_size=args.train_batch_size, 
+                                                       split='train')
+        
+        val_dataloader = create_streaming_dataloader(args.dataset, 
+                                                      args.tokenizer, 
+                                                      name=args.dataset_config_name, 
+                                                      batch_size=args.train_batch_size, 
+                                                      prefetch_factor=2,
+                                                      split='validation')
     
     train(model, 
           optimizer, 
@@ -275,6 +333,7 @@ def main(args):
           world_size,
           total_steps,
           start_batch_index)
+    wait_for_checkpoint()
   
     dist.destroy_process_group()
 